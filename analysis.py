@@ -0,0 +1,1084 @@
+"""
+米国主要小売業 財務分析ダッシュボードの共通ロジック。
+データ読み込み・集計・チャート描画・デプロイ用バンドルを扱い、
+app.py（画面）と build_bundle.py（ビルド手順）の両方から利用する。
+"""
+import streamlit as st
+import pandas as pd
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+import matplotlib.font_manager as fm
+import seaborn as sns
+import hashlib
+import os
+import io
+import pickle
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_PATH = os.path.join(BASE_DIR, "data", "financial_data_us.xlsx")
+BUNDLE_PATH = os.path.join(BASE_DIR, "data", "app_bundle.pkl")
+
+# ==========================================
+# 1. フォント設定
+# ==========================================
+def setup_font():
+    """
+    fontsフォルダから日本語フォントを読み込む。
+    Cloud環境とローカル環境の両方に対応。
+    """
+    font_path = os.path.join(BASE_DIR, "fonts", "ipaexg.ttf")
+
+    if os.path.exists(font_path):
+        fm.fontManager.addfont(font_path)
+        prop = fm.FontProperties(fname=font_path)
+        plt.rcParams['font.family'] = prop.get_name()
+        return prop.get_name()
+    else:
+        # フォールバック
+        default_fonts = ['Meiryo', 'Yu Gothic', 'Hiragino Sans', 'TakaoGothic', 'IPAGothic']
+        plt.rcParams['font.family'] = default_fonts
+        return 'sans-serif'
+
+font_name = setup_font()
+sns.set_theme(style="whitegrid", rc={"font.family": font_name})
+
+# ==========================================
+# 2. カラーパレット定義（app_compare.pyと統一）
+# ==========================================
+COLORS = {
+    'primary': ['#2E86AB', '#A23B72', '#F18F01', '#C73E1D', '#3B1F2B', '#95C623', '#5C4D7D'],
+    'accent': '#FF6B6B',
+    'others': '#B0B0B0',
+    'background': '#F8F9FA',
+    'text': '#2C3E50'
+}
+
+def get_company_colors(companies):
+    """企業ごとに一貫した色を割り当て"""
+    return {company: COLORS['primary'][i % len(COLORS['primary'])] for i, company in enumerate(companies)}
+
+# ==========================================
+# 3. ユーティリティ関数
+# ==========================================
+def format_fy(year):
+    """年度をFYフォーマットに変換"""
+    try:
+        return f"FY{int(year)}"
+    except:
+        return year
+
+def safe_divide(numerator, denominator, default=0):
+    """ゼロ除算を回避する除算"""
+    return np.where(denominator != 0, numerator / denominator, default)
+
+def render_figure(fig, formats=('png',), close=True):
+    """
+    Figureを指定形式で書き出して閉じる（形式 -> バイト列）。
+    st.pyplot と同じ設定（dpi=200, bbox_inches='tight'）で描画する。
+    """
+    images = {}
+    for fmt in formats:
+        buf = io.BytesIO()
+        fig.savefig(buf, format=fmt, dpi=200, bbox_inches='tight', facecolor='white')
+        images[fmt] = buf.getvalue()
+    if close:
+        plt.close(fig)
+    return images
+
+# レポート画像の設定（形式・最大幅・1枚あたりの容量上限）
+REPORT_IMAGE_FORMATS = ['WebP', 'PNG', 'SVG']
+DEFAULT_REPORT_IMAGE_OPTIONS = {
+    'format': 'WebP',
+    'max_width': 1200,
+    'max_bytes': None,
+}
+REPORT_ENCODE_WORKERS = 4
+
+def encode_report_image(chart, image_format='WebP', max_width=None, max_bytes=None):
+    """
+    レポート用にチャート画像を変換して (MIMEタイプ, バイト列) を返す。
+    chart は描画済みの画像（形式 -> バイト列）、PNGバイト列、または Figure。
+    ラスタ形式は画面用PNGを縮小・再圧縮し（PNGは256色に減色）、容量上限を超える場合は
+    画質（WebP）→ 縮小の順に上限に収まるまで段階的に下げる。
+    """
+    from PIL import Image
+
+    if isinstance(chart, bytes):
+        chart = {'png': chart}
+    elif not isinstance(chart, dict):
+        chart = render_figure(chart, ('png', 'svg') if image_format == 'SVG' else ('png',), close=False)
+
+    if image_format == 'SVG' and 'svg' in chart and not (max_bytes and len(chart['svg']) > max_bytes):
+        return 'image/svg+xml', chart['svg']
+    if image_format == 'SVG':
+        # ベクター形式がない（事前描画画像など）または容量上限を超える場合はPNGで埋め込む
+        image_format = 'PNG'
+
+    img = Image.open(io.BytesIO(chart['png'])).convert('RGB')
+    if max_width and img.width > max_width:
+        img = img.resize((max_width, round(img.height * max_width / img.width)), Image.LANCZOS, reducing_gap=2.0)
+
+    # 容量上限を超えたときに順に試す圧縮設定
+    if image_format == 'WebP':
+        steps = [{'quality': q} for q in (90, 75, 60, 45)]
+    else:
+        # PNGは画質の段階を持たない（チャートは色数が少ないため常に256色に減色する）
+        steps = [{}]
+
+    def _encode(image, step):
+        buf = io.BytesIO()
+        if image_format == 'WebP':
+            image.save(buf, format='WEBP', quality=step['quality'], method=2)
+        else:
+            image.quantize(colors=256).save(buf, format='PNG', optimize=True)
+        return buf.getvalue()
+
+    # 容量上限に収まるまで画質を下げ、それでも超える場合は上限に収まるまで縮小する
+    data = _encode(img, steps[0])
+    while max_bytes and len(data) > max_bytes:
+        if len(steps) > 1:
+            steps.pop(0)
+        elif img.width > 1:
+            width = min(int(img.width * 0.8), img.width - 1)
+            height = max(1, round(img.height * width / img.width))
+            img = img.resize((width, height), Image.LANCZOS, reducing_gap=2.0)
+        else:
+            break
+        data = _encode(img, steps[0])
+
+    mime = 'image/webp' if image_format == 'WebP' else 'image/png'
+    return mime, data
+
+def _report_image_kwargs(image_options=None):
+    """レポート画像の設定を encode_report_image の引数に変換する（未指定は初期値）"""
+    options = {**DEFAULT_REPORT_IMAGE_OPTIONS, **(image_options or {})}
+    return {
+        'image_format': options['format'],
+        'max_width': options['max_width'],
+        'max_bytes': options['max_bytes'],
+    }
+
+@st.cache_data(max_entries=500, show_spinner=False)
+def _encode_report_png(digest, image_format, max_width, max_bytes, _png):
+    """PNG画像のレポート用変換をメモ化する（キーは画像のダイジェストと変換設定）"""
+    return encode_report_image(_png, image_format, max_width, max_bytes)
+
+def encode_report_images(charts, image_options=None):
+    """
+    複数のチャート画像をワーカープールで並列に変換する。
+    変換結果は画像のダイジェストと設定をキーにメモ化する。再実行のたびに
+    同じ画像を変換し直さないため（download_button はデータを先に必要とする）。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+    kwargs = _report_image_kwargs(image_options)
+    cache_key = tuple(kwargs.values())
+
+    def _encode(chart):
+        if isinstance(chart, bytes):
+            chart = {'png': chart}
+        elif not isinstance(chart, dict):
+            return encode_report_image(chart, **kwargs)
+
+        if kwargs['image_format'] == 'SVG' and 'svg' in chart:
+            if not (kwargs['max_bytes'] and len(chart['svg']) > kwargs['max_bytes']):
+                return 'image/svg+xml', chart['svg']
+        digest = hashlib.sha256(chart['png']).hexdigest()
+        return _encode_report_png(digest, *cache_key, chart['png'])
+
+    if len(charts) <= 1:
+        return [_encode(chart) for chart in charts]
+
+    # ワーカーからもキャッシュを使えるよう、実行中のスクリプトのコンテキストを引き継ぐ
+    ctx = get_script_run_ctx(suppress_warning=True)
+
+    def _attach_ctx():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+
+    with ThreadPoolExecutor(max_workers=min(REPORT_ENCODE_WORKERS, len(charts)), initializer=_attach_ctx) as pool:
+        return list(pool.map(_encode, charts))
+
+def get_html_report(df, title, fig=None, image_options=None, trend=None):
+    """
+    HTMLダウンロード用データの生成（テーブル＋チャート）
+    - df: テーブル、または (見出し, テーブル) のリスト
+    - fig: チャート、または (見出し, チャート) のリスト。
+      チャートは Figure・PNGバイト列・描画済み画像のいずれか
+    - trend: (見出し, [(見出し, チャート), ...]) を渡すとトレンド分析の節を追加
+    画像はすべて image_options（形式・最大幅・容量上限）に従ってまとめて変換する。
+    """
+    import base64
+
+    if fig is None:
+        charts = []
+    elif isinstance(fig, list):
+        charts = [item if isinstance(item, tuple) else (None, item) for item in fig]
+    else:
+        charts = [(None, fig)]
+    trend_charts = trend[1] if trend else []
+    tables = df if isinstance(df, list) else [("📋 詳細データ", df)]
+
+    # チャートを変換してbase64エンコード（タブとトレンドの画像を一括で並列変換）
+    encoded = encode_report_images([chart for _, chart in charts + trend_charts], image_options)
+
+    def _chart_html(heading, mime, data):
+        img_base64 = base64.b64encode(data).decode('utf-8')
+        heading_html = f'<h4>{heading}</h4>' if heading else ''
+        return f'{heading_html}<div style="text-align:center; margin: 20px 0;"><img src="data:{mime};base64,{img_base64}" style="max-width:100%;"/></div>'
+
+    chart_html = "".join(
+        _chart_html(heading, mime, data)
+        for (heading, _), (mime, data) in zip(charts, encoded[:len(charts)])
+    )
+    table_html = "".join(
+        f"<h3>{heading}</h3>{table.to_html(classes='data-table')}"
+        for heading, table in tables
+    )
+    trend_html = ""
+    if trend:
+        trend_html = f"<h3>{trend[0]}</h3>" + "".join(
+            _chart_html(heading, mime, data)
+            for (heading, _), (mime, data) in zip(trend_charts, encoded[len(charts):])
+        )
+
+    return f"""
+    <html><head><meta charset='utf-8'>
+    <style>
+        body {{ font-family: 'Hiragino Sans', 'Meiryo', sans-serif; padding: 20px; background: #f5f5f5; }}
+        .container {{ max-width: 1200px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
+        table {{ border-collapse: collapse; width: 100%; margin-top: 20px; background: white; }}
+        th, td {{ border: 1px solid #ddd; padding: 10px; text-align: right; }}
+        th {{ background: linear-gradient(135deg, #2E86AB, #A23B72); color: white; text-align: center; }}
+        tr:nth-child(even) {{ background-color: #f9f9f9; }}
+        tr:hover {{ background-color: #f0f0f0; }}
+        h2 {{ color: #2C3E50; border-left: 5px solid #2E86AB; padding-left: 15px; margin-top: 0; }}
+        h3 {{ color: #2C3E50; margin-top: 30px; }}
+        h4 {{ color: #555; margin: 20px 0 0; }}
+        .timestamp {{ color: #888; font-size: 12px; text-align: right; margin-top: 20px; }}
+    </style></head>
+    <body>
+    <div class="container">
+        <h2>{title}</h2>
+        {chart_html}
+        {table_html}
+        {trend_html}
+        <p class="timestamp">生成日時: {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
+    </div>
+    </body></html>
+    """
+
+# ==========================================
+# 4. カテゴリグループ定義
+# ==========================================
+# カテゴリ定義は data/category_groups.csv（列: カテゴリ, 企業名）で管理する。
+# 1行が1社の所属を表し、同じ企業を複数のカテゴリに登録できる。
+CATEGORY_PATH = os.path.join(BASE_DIR, "data", "category_groups.csv")
+CUSTOM_CATEGORY = 'カスタム'
+
+def read_category_groups(path=CATEGORY_PATH):
+    """カテゴリ定義を読み込む（カテゴリ -> 企業名リスト、ファイル内の順序を保持）"""
+    if not os.path.exists(path):
+        return {}
+
+    df = pd.read_csv(path, dtype=str).dropna(subset=['カテゴリ', '企業名'])
+    df = df.apply(lambda col: col.str.strip()).drop_duplicates()
+    # 「カスタム」は全企業から選ぶ予約カテゴリのため、CSVでの定義は無視する
+    df = df[df['カテゴリ'] != CUSTOM_CATEGORY]
+    return {
+        category: members['企業名'].tolist()
+        for category, members in df.groupby('カテゴリ', sort=False)
+    }
+
+def build_category_index(category_groups, available_companies):
+    """
+    企業⇔カテゴリの対応を事前計算する。
+    - options: カテゴリ -> データに存在する所属企業（定義順）
+    - members: カテゴリ -> 所属企業の集合（重複・包含の判定用）
+    - company_categories: 企業名 -> 所属カテゴリのリスト
+    """
+    available = set(available_companies)
+    options = {}
+    members = {}
+    company_categories = {}
+    for category, companies in category_groups.items():
+        options[category] = [c for c in companies if c in available]
+        members[category] = frozenset(options[category])
+        for company in options[category]:
+            company_categories.setdefault(company, []).append(category)
+    return {
+        'categories': list(category_groups) + [CUSTOM_CATEGORY],
+        'options': options,
+        'members': members,
+        'company_categories': company_categories,
+    }
+
+def load_category_index(available_companies, path=CATEGORY_PATH):
+    """
+    カテゴリ定義CSVを読み込んで企業⇔カテゴリの対応を返す。
+    CSVの更新日時とデータの企業一覧ごとに1回だけ構築し、以降の再実行では
+    キャッシュ済みの索引（読み取り専用）をそのまま返す。
+    """
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    return _load_category_index(path, mtime, hash(tuple(available_companies)), available_companies)
+
+@st.cache_resource
+def _load_category_index(path, mtime, companies_key, _available_companies):
+    """カテゴリ索引の構築本体（キーは path・更新日時・企業一覧のハッシュのみ）"""
+    return build_category_index(read_category_groups(path), _available_companies)
+
+def get_category_options(category, available_companies, category_index):
+    """カテゴリの選択肢と初期選択企業を返す"""
+    if category == CUSTOM_CATEGORY:
+        options = available_companies
+        default_selection = options[:3] if len(options) >= 3 else options
+    else:
+        options = category_index['options'][category]
+        default_selection = options
+    return options, default_selection
+
+def get_company_categories(category_index, company):
+    """企業が所属するカテゴリの一覧"""
+    return category_index['company_categories'].get(company, [])
+
+def get_category_overlap(category_index, category_a, category_b):
+    """2つのカテゴリに共通して所属する企業"""
+    return category_index['members'][category_a] & category_index['members'][category_b]
+
+# ==========================================
+# 5. データ読み込み & 前処理
+# ==========================================
+@st.cache_data
+def load_data():
+    """Excelデータを読み込む"""
+    if not os.path.exists(DATA_PATH):
+        return None
+
+    df = pd.read_excel(DATA_PATH)
+    return df
+
+# 類似企業検索に使う指標（利益率・回転率・財務レバレッジ・生産性）
+SIMILARITY_METRICS = [
+    '売上総利益率', '営業利益率', '販管費率',
+    '棚卸資産回転率', '総資産回転率',
+    '自己資本比率',
+    '全従業員1人当り売上高'
+]
+
+# 距離を計算するのに必要な、両社に値がある指標の最小数
+MIN_COMMON_METRICS = 3
+
+@st.cache_data
+def build_similarity_index(df):
+    """
+    年度ごとに企業間の距離行列を事前計算する。
+    各指標を年度内でZスコア正規化し、両社に値がある指標のみで
+    二乗平均平方根距離を求める（欠損指標は比較対象から除外）。
+    共通の指標が MIN_COMMON_METRICS 未満の組み合わせは距離なし（NaN）とする。
+    メモリ使用量を 企業数×企業数 に抑えるため、指標ごとに順に加算する。
+    """
+    df = add_productivity_metrics(df)
+    metrics = [m for m in SIMILARITY_METRICS if m in df.columns]
+    index = {}
+    for year, df_year in df.groupby('決算年度'):
+        values = df_year.groupby('企業名')[metrics].mean()
+        std = values.std(ddof=0).replace(0, np.nan)
+        z = ((values - values.mean()) / std).to_numpy()
+
+        n = len(values)
+        sq_sum = np.zeros((n, n))
+        n_common = np.zeros((n, n), dtype=np.int16)
+        for k in range(z.shape[1]):
+            valid = ~np.isnan(z[:, k])
+            col = np.where(valid, z[:, k], 0.0)
+            both = np.logical_and.outer(valid, valid)
+            sq_diff = np.subtract.outer(col, col)
+            np.square(sq_diff, out=sq_diff)
+            sq_diff[~both] = 0.0
+            sq_sum += sq_diff
+            n_common += both
+
+        # 共通指標のない組み合わせ（0 / 0）は NaN のままにする
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dist = np.sqrt(safe_divide(sq_sum, n_common, np.nan))
+        dist[n_common < MIN_COMMON_METRICS] = np.nan
+
+        index[year] = pd.DataFrame(dist, index=values.index, columns=values.index)
+    return index
+
+def find_similar_companies(similarity_index, year, company, top_n=5):
+    """基準企業に近い企業を距離の昇順で返す（Series: 企業名 -> 距離）"""
+    dist = similarity_index.get(year)
+    if dist is None or company not in dist.index:
+        return pd.Series(dtype=float)
+    return dist.loc[company].drop(company).dropna().nsmallest(top_n)
+
+def add_productivity_metrics(df):
+    """生産性指標がデータにない場合は計算する（千ドル単位）"""
+    if '全従業員1人当り売上高' in df.columns:
+        return df
+
+    df = df.copy()
+    df['全従業員1人当り売上高'] = safe_divide(
+        df['売上高'],
+        df['従業員数']
+    ) / 1000  # 千ドル単位
+
+    df['全従業員1人当り営業利益'] = safe_divide(
+        df['営業利益'],
+        df['従業員数']
+    ) / 1000  # 千ドル単位
+    return df
+
+# ヒートマップで選べる指標（各タブの詳細データと同じ指標、タブ順。指標 -> 単位。
+# 'amount' は表示通貨単位で換算）
+HEATMAP_METRICS = {
+    # 損益計算書
+    '売上高': 'amount',
+    '売上原価': 'amount',
+    '販管費': 'amount',
+    '営業利益': 'amount',
+    '売上総利益率': '%',
+    '営業利益率': '%',
+    '販管費率': '%',
+    # 貸借対照表
+    '総資産': 'amount',
+    '流動資産': 'amount',
+    '棚卸資産': 'amount',
+    '純資産': 'amount',
+    '有利子負債': 'amount',
+    '自己資本比率': '%',
+    # 財務指標
+    '棚卸資産回転率': '回',
+    '総資産回転率': '回',
+    # キャッシュフロー
+    '営業CF': 'amount',
+    '投資CF': 'amount',
+    'フリーCF': 'amount',
+    # 生産性
+    '従業員数': '人',
+    '全従業員1人当り売上高': '千ドル / 人',
+    '全従業員1人当り営業利益': '千ドル / 人',
+}
+
+@st.cache_data
+def build_metric_pivot(df):
+    """
+    全指標を 企業 × (指標, 年度) の1つの表にまとめる。
+    ヒートマップはこの表から列を切り出すだけで作成できる。
+    """
+    df = add_productivity_metrics(df)
+    metrics = [m for m in HEATMAP_METRICS if m in df.columns]
+    return df.pivot_table(index='企業名', columns='決算年度', values=metrics, aggfunc='mean')
+
+def get_heatmap_matrix(metric_pivot, metric, companies, zscore=False):
+    """
+    指定指標の 企業 × 年度 行列を返す（最新年度の値の降順）。
+    zscore=True の場合は年度ごとに企業間でZスコア正規化する。
+    """
+    matrix = metric_pivot[metric].reindex(companies)
+    if zscore:
+        matrix = (matrix - matrix.mean()) / matrix.std(ddof=0).replace(0, np.nan)
+
+    latest = matrix.ffill(axis=1).iloc[:, -1]
+    return matrix.loc[latest.sort_values(ascending=False, na_position='last').index]
+
+def get_heatmap_metrics(metric_pivot):
+    """ヒートマップで選べる指標（データにあるもの、先頭が初期表示）"""
+    available = set(metric_pivot.columns.get_level_values(0))
+    return [m for m in HEATMAP_METRICS if m in available]
+
+def build_heatmap_matrix(metric_pivot, metric, companies, unit_scale, unit_label, zscore=False):
+    """
+    ヒートマップに表示する行列と単位を返す。
+    金額指標は表示通貨単位に換算する（Zスコアは単位なし）。
+    """
+    matrix = get_heatmap_matrix(metric_pivot, metric, companies, zscore)
+    unit = HEATMAP_METRICS[metric]
+    if unit == 'amount':
+        unit = unit_label
+        if not zscore:
+            matrix = matrix / unit_scale
+    return matrix, unit
+
+def heatmap_chart_id(metric):
+    """事前描画画像でのヒートマップのID"""
+    return f"heatmap:{metric}"
+
+# 大量選択モード：チャートは上位N社＋「その他」、テーブルはページ分割
+LARGE_SELECTION_THRESHOLD = 15
+CHART_TOP_N = 10
+TABLE_PAGE_SIZE = 20
+
+# 「その他」集計で合算する金額列と、合算値から再計算する比率列
+AMOUNT_COLUMNS = [
+    '売上高', '売上原価', '売上総利益', '販管費', '営業利益', '当期純利益',
+    '総資産', '流動資産', '棚卸資産', '純資産', '有利子負債',
+    '営業CF', '投資CF', 'フリーCF', '従業員数'
+]
+RATIO_DEFINITIONS = {
+    '売上総利益率': ('売上総利益', '売上高', 100),
+    '営業利益率': ('営業利益', '売上高', 100),
+    '原価率': ('売上原価', '売上高', 100),
+    '販管費率': ('販管費', '売上高', 100),
+    '棚卸資産回転率': ('売上高', '棚卸資産', 1),
+    '総資産回転率': ('売上高', '総資産', 1),
+    '自己資本比率': ('純資産', '総資産', 100),
+}
+
+def _paired_ratio(others, num, den, years):
+    """分子・分母の両方が分かる行だけを年度ごとに合算して比率を求める"""
+    paired = others[others[num].notna() & others[den].notna()]
+    sums = paired.groupby('決算年度')[[num, den]].sum().reindex(years)
+    return safe_divide(sums[num].values, sums[den].values, np.nan)
+
+def aggregate_others(df, keep_companies, label):
+    """
+    keep_companies 以外の企業を年度ごとに1行（label）へ集約する。
+    金額列は合算し、比率列は分子・分母がそろう企業の合算値から再計算する。
+    """
+    keep = df['企業名'].isin(keep_companies)
+    others = df[~keep]
+    if others.empty:
+        return df
+
+    amounts = [c for c in AMOUNT_COLUMNS if c in df.columns]
+    agg = others.groupby('決算年度')[amounts].sum(min_count=1).reset_index()
+    agg.insert(0, '企業名', label)
+
+    for ratio, (num, den, scale) in RATIO_DEFINITIONS.items():
+        if ratio in df.columns and num in others.columns and den in others.columns:
+            agg[ratio] = _paired_ratio(others, num, den, agg['決算年度']) * scale
+
+    # 1人当り指標（千ドル単位）
+    if '従業員数' in others.columns:
+        agg['全従業員1人当り売上高'] = _paired_ratio(others, '売上高', '従業員数', agg['決算年度']) / 1000
+        agg['全従業員1人当り営業利益'] = _paired_ratio(others, '営業利益', '従業員数', agg['決算年度']) / 1000
+
+    return pd.concat([df[keep], agg], ignore_index=True)
+
+def _aggregate_chart_data(df, top_companies, colors):
+    """
+    上位企業以外を「その他（N社）」に集約し、(データ, 描画順の企業リスト) を返す。
+    N はこのデータに含まれる企業数で数える（年度比較とトレンドで異なりうる）。
+    """
+    n_others = df.loc[~df['企業名'].isin(top_companies), '企業名'].nunique()
+    if n_others == 0:
+        return df, list(top_companies)
+
+    others_label = f"その他（{n_others}社）"
+    colors[others_label] = COLORS['others']
+    return aggregate_others(df, top_companies, others_label), list(top_companies) + [others_label]
+
+def build_view(df_raw, companies, year, unit_scale, unit_label, show_trend=True):
+    """選択条件から各タブで使う比較用データ一式を作成する"""
+    all_years = sorted(df_raw['決算年度'].unique())
+
+    # データフィルタリング
+    df_compare = df_raw[
+        (df_raw['企業名'].isin(companies)) &
+        (df_raw['決算年度'] == year)
+    ].copy()
+    df_compare = add_productivity_metrics(df_compare)
+
+    # トレンド用データ（過去5年）
+    trend_years = [y for y in range(year - 4, year + 1) if y in all_years]
+    if show_trend:
+        df_trend = df_raw[
+            (df_raw['企業名'].isin(companies)) &
+            (df_raw['決算年度'].isin(trend_years))
+        ].copy()
+    else:
+        df_trend = pd.DataFrame()
+
+    # 企業ごとの色を設定
+    colors = get_company_colors(companies)
+
+    # 選択企業が多い場合、チャートは売上高上位N社＋その他に集約する
+    large_selection = len(companies) > LARGE_SELECTION_THRESHOLD
+    chart_companies = list(companies)
+    trend_chart_companies = list(companies)
+    df_chart = df_compare
+    df_trend_chart = df_trend
+    if large_selection:
+        top_companies = (
+            df_compare.sort_values('売上高', ascending=False)['企業名'].head(CHART_TOP_N).tolist()
+        )
+        df_chart, chart_companies = _aggregate_chart_data(df_compare, top_companies, colors)
+        if not df_trend.empty:
+            df_trend_chart, trend_chart_companies = _aggregate_chart_data(df_trend, top_companies, colors)
+
+    return {
+        'companies': list(companies),
+        'year': year,
+        'unit_scale': unit_scale,
+        'unit_label': unit_label,
+        'df_compare': df_compare,
+        'df_trend': df_trend,
+        'trend_years': trend_years,
+        'colors': colors,
+        'large_selection': large_selection,
+        # チャート描画用（大量選択時は上位N社＋その他）
+        'chart_companies': chart_companies,
+        'trend_chart_companies': trend_chart_companies,
+        'df_chart': df_chart,
+        'df_trend_chart': df_trend_chart,
+    }
+
+def view_key(view):
+    """事前描画チャートの照合に使うキー"""
+    return (tuple(view['companies']), int(view['year']), view['unit_scale'])
+
+# ==========================================
+# 6. チャート描画
+# ==========================================
+def plot_pl_composition(view):
+    """売上構成（積み上げ）"""
+    df_display = view['df_chart'].sort_values('売上高', ascending=False)
+    plot_data = df_display[['企業名', '売上原価', '販管費', '営業利益']].set_index('企業名')
+    plot_data = plot_data / view['unit_scale']
+
+    fig1, ax1 = plt.subplots(figsize=(10, 6))
+    plot_data.plot(
+        kind='bar',
+        stacked=True,
+        ax=ax1,
+        color=['#A9A9A9', '#87CEEB', '#FF8C00']
+    )
+    ax1.set_ylabel(f"金額 ({view['unit_label']})")
+    ax1.set_xlabel("")
+    ax1.legend(["売上原価", "販管費", "営業利益"], loc='upper right')
+    ax1.set_title(f"{format_fy(view['year'])} 売上構成", fontweight='bold')
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    return fig1
+
+def plot_operating_margin(view):
+    """営業利益率比較"""
+    df_display = view['df_chart'].sort_values('売上高', ascending=False)
+
+    fig2, ax2 = plt.subplots(figsize=(5, 6))
+    colors_list = [view['colors'][c] for c in df_display['企業名']]
+    sns.barplot(
+        data=df_display,
+        y='企業名',
+        x='営業利益率',
+        ax=ax2,
+        palette=colors_list
+    )
+    ax2.set_xlabel("営業利益率 (%)")
+    ax2.set_ylabel("")
+    ax2.grid(axis='x', linestyle='--', alpha=0.7)
+    ax2.set_title('営業利益率', fontweight='bold')
+    plt.tight_layout()
+    return fig2
+
+def plot_total_assets(view):
+    """総資産規模"""
+    df_display = view['df_chart'].sort_values('総資産', ascending=False)
+
+    fig3, ax3 = plt.subplots(figsize=(10, 6))
+    colors_list = [view['colors'][c] for c in df_display['企業名']]
+    ax3.bar(
+        df_display['企業名'],
+        df_display['総資産'] / view['unit_scale'],
+        color=colors_list
+    )
+    ax3.set_ylabel(f"総資産 ({view['unit_label']})")
+    ax3.set_title('総資産比較', fontweight='bold')
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    return fig3
+
+def plot_equity_ratio(view):
+    """自己資本比率"""
+    df_display = view['df_chart'].sort_values('総資産', ascending=False)
+
+    fig4, ax4 = plt.subplots(figsize=(10, 6))
+    colors_list = [view['colors'][c] for c in df_display['企業名']]
+    sns.barplot(
+        data=df_display,
+        x='企業名',
+        y='自己資本比率',
+        palette=colors_list,
+        ax=ax4
+    )
+    ax4.set_ylabel("自己資本比率 (%)")
+    ax4.set_xlabel("")
+    ax4.set_title('自己資本比率', fontweight='bold')
+    ax4.axhline(y=50, color='red', linestyle='--', linewidth=1, alpha=0.7, label='50%基準線')
+    ax4.legend()
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    return fig4
+
+def plot_inventory_vs_margin(view):
+    """在庫効率 vs 収益性"""
+    df_display = view['df_chart']
+
+    fig5, ax5 = plt.subplots(figsize=(8, 6))
+    for company in df_display['企業名']:
+        company_data = df_display[df_display['企業名'] == company]
+        ax5.scatter(
+            company_data['棚卸資産回転率'],
+            company_data['営業利益率'],
+            s=200,
+            color=view['colors'][company],
+            label=company,
+            alpha=0.7
+        )
+        # ラベル追加
+        ax5.text(
+            company_data['棚卸資産回転率'].values[0],
+            company_data['営業利益率'].values[0] + 0.3,
+            company,
+            fontsize=9,
+            ha='center'
+        )
+
+    ax5.set_xlabel("棚卸資産回転率 (回)")
+    ax5.set_ylabel("営業利益率 (%)")
+    ax5.set_title('在庫効率と収益性', fontweight='bold')
+    ax5.grid(True, linestyle=':', alpha=0.7)
+    plt.tight_layout()
+    return fig5
+
+def plot_asset_turnover(view):
+    """総資産回転率"""
+    df_display = view['df_chart']
+
+    fig6, ax6 = plt.subplots(figsize=(8, 6))
+    colors_list = [view['colors'][c] for c in df_display['企業名']]
+    ax6.barh(
+        df_display['企業名'],
+        df_display['総資産回転率'],
+        color=colors_list
+    )
+    ax6.set_xlabel("総資産回転率 (回)")
+    ax6.set_title('総資産回転率', fontweight='bold')
+    ax6.grid(axis='x', linestyle='--', alpha=0.7)
+    plt.tight_layout()
+    return fig6
+
+def plot_operating_cf(view):
+    """営業キャッシュフロー"""
+    df_display = view['df_chart']
+
+    fig7, ax7 = plt.subplots(figsize=(10, 6))
+    cf_colors = ['#2E86AB' if v >= 0 else '#C73E1D'
+                for v in df_display['営業CF']]
+    ax7.bar(
+        df_display['企業名'],
+        df_display['営業CF'] / view['unit_scale'],
+        color=cf_colors
+    )
+    ax7.axhline(y=0, color='black', linewidth=0.5)
+    ax7.set_ylabel(f"営業CF ({view['unit_label']})")
+    ax7.set_title('営業キャッシュフロー', fontweight='bold')
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    return fig7
+
+def plot_free_cf(view):
+    """フリーキャッシュフロー"""
+    df_display = view['df_chart']
+
+    fig8, ax8 = plt.subplots(figsize=(10, 6))
+    free_colors = ['#95C623' if v >= 0 else '#C73E1D'
+                  for v in df_display['フリーCF']]
+    ax8.bar(
+        df_display['企業名'],
+        df_display['フリーCF'] / view['unit_scale'],
+        color=free_colors
+    )
+    ax8.axhline(y=0, color='black', linewidth=0.5)
+    ax8.set_ylabel(f"フリーCF ({view['unit_label']})")
+    ax8.set_title('フリーキャッシュフロー', fontweight='bold')
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    return fig8
+
+def plot_cf_comparison(view):
+    """キャッシュフロー構成比較"""
+    df_display = view['df_chart']
+    unit_scale = view['unit_scale']
+
+    fig9, ax9 = plt.subplots(figsize=(12, 5))
+    x = np.arange(len(df_display))
+    width = 0.25
+
+    ax9.bar(x - width, df_display['営業CF'] / unit_scale,
+           width, label='営業CF', color='#2E86AB')
+    ax9.bar(x, df_display['投資CF'] / unit_scale,
+           width, label='投資CF', color='#F18F01')
+    ax9.bar(x + width, df_display['フリーCF'] / unit_scale,
+           width, label='フリーCF', color='#95C623')
+
+    ax9.axhline(y=0, color='black', linewidth=0.5)
+    ax9.set_xticks(x)
+    ax9.set_xticklabels(df_display['企業名'], rotation=45, ha='right')
+    ax9.legend()
+    ax9.set_ylabel(f"金額 ({view['unit_label']})")
+    ax9.set_title('キャッシュフロー比較', fontweight='bold')
+    plt.tight_layout()
+    return fig9
+
+def plot_sales_per_employee(view):
+    """従業員1人当り売上高"""
+    df_display = view['df_chart']
+
+    fig10, ax10 = plt.subplots(figsize=(10, 6))
+    colors_list = [view['colors'][c] for c in df_display['企業名']]
+    ax10.bar(
+        df_display['企業名'],
+        df_display['全従業員1人当り売上高'],
+        color=colors_list
+    )
+    ax10.set_ylabel("売上高 (千ドル / 人)")
+    ax10.set_title('従業員1人当り売上高', fontweight='bold')
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    return fig10
+
+def plot_op_income_per_employee(view):
+    """従業員1人当り営業利益"""
+    df_display = view['df_chart']
+
+    fig11, ax11 = plt.subplots(figsize=(10, 6))
+    ax11.bar(
+        df_display['企業名'],
+        df_display['全従業員1人当り営業利益'],
+        color='#F18F01'
+    )
+    ax11.set_ylabel("営業利益 (千ドル / 人)")
+    ax11.set_title('従業員1人当り営業利益', fontweight='bold')
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    return fig11
+
+def _plot_trend(view, column, scale, ylabel, title, marker):
+    """企業別の推移（折れ線）"""
+    df_trend = view['df_trend_chart']
+
+    fig, ax = plt.subplots(figsize=(10, 6))
+    for company in view['trend_chart_companies']:
+        company_trend = df_trend[df_trend['企業名'] == company].sort_values('決算年度')
+        if not company_trend.empty:
+            ax.plot(
+                company_trend['決算年度'].apply(format_fy),
+                company_trend[column] / scale,
+                marker=marker,
+                label=company,
+                color=view['colors'][company],
+                linewidth=2
+            )
+
+    ax.set_ylabel(ylabel)
+    ax.set_title(title, fontweight='bold')
+    ax.legend(loc='best', fontsize=9)
+    ax.grid(True, linestyle=':', alpha=0.7)
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    return fig
+
+def plot_sales_trend(view):
+    """売上高推移"""
+    return _plot_trend(view, '売上高', view['unit_scale'], f"売上高 ({view['unit_label']})", '売上高推移', 'o')
+
+def plot_margin_trend(view):
+    """営業利益率推移"""
+    return _plot_trend(view, '営業利益率', 1, '営業利益率 (%)', '営業利益率推移', 's')
+
+# これを超える企業数では企業名・数値ラベルを省略する
+HEATMAP_LABEL_LIMIT = 60
+HEATMAP_ANNOTATION_LIMIT = 300
+
+def cmap_with_missing(name):
+    """欠損セルを灰色で表示するカラーマップ（Zスコア0の白と区別する）"""
+    cmap = matplotlib.colormaps[name].copy()
+    cmap.set_bad('#E0E0E0')
+    return cmap
+
+def plot_metric_heatmap(matrix, metric, unit_label, zscore=False):
+    """
+    企業 × 年度のヒートマップ。
+    企業数が多くても1枚の画像（imshow）で描画する。
+    """
+    n_rows, n_cols = matrix.shape
+    values = np.ma.masked_invalid(matrix.to_numpy(dtype=float))
+
+    height = min(max(3, 0.35 * n_rows + 1.5), 14)
+    fig, ax = plt.subplots(figsize=(10, height))
+    if zscore:
+        limit = min(np.nanmax(np.abs(values.filled(np.nan))) if values.count() else 1, 3)
+        im = ax.imshow(values, aspect='auto', cmap=cmap_with_missing('RdBu_r'), vmin=-limit, vmax=limit, interpolation='nearest')
+        colorbar_label = "Zスコア（年度内）"
+    else:
+        im = ax.imshow(values, aspect='auto', cmap=cmap_with_missing('YlGnBu'), interpolation='nearest')
+        colorbar_label = f"{metric} ({unit_label})"
+    ax.grid(False)
+
+    ax.set_xticks(np.arange(n_cols))
+    ax.set_xticklabels([format_fy(y) for y in matrix.columns])
+    if n_rows <= HEATMAP_LABEL_LIMIT:
+        ax.set_yticks(np.arange(n_rows))
+        ax.set_yticklabels(matrix.index, fontsize=9)
+    else:
+        ax.set_yticks([])
+        ax.set_ylabel(f"{n_rows}社（最新年度の値の降順）")
+
+    # セル数が少ない場合のみ数値を表示
+    if n_rows * n_cols <= HEATMAP_ANNOTATION_LIMIT:
+        fmt = '{:.2f}' if zscore or unit_label == '回' else '{:,.1f}'
+        threshold = (im.norm.vmin + im.norm.vmax) / 2
+        for i, j in zip(*np.nonzero(~values.mask)):
+            v = values[i, j]
+            color = 'white' if (abs(v) > limit / 2 if zscore else v > threshold) else 'black'
+            ax.text(j, i, fmt.format(v), ha='center', va='center', fontsize=8, color=color)
+
+    fig.colorbar(im, ax=ax, label=colorbar_label, fraction=0.04, pad=0.02)
+    ax.set_title(f"{metric} の推移" + ("（Zスコア）" if zscore else ""), fontweight='bold')
+    plt.tight_layout()
+    return fig
+
+CHART_BUILDERS = {
+    'pl_composition': plot_pl_composition,
+    'operating_margin': plot_operating_margin,
+    'total_assets': plot_total_assets,
+    'equity_ratio': plot_equity_ratio,
+    'inventory_vs_margin': plot_inventory_vs_margin,
+    'asset_turnover': plot_asset_turnover,
+    'operating_cf': plot_operating_cf,
+    'free_cf': plot_free_cf,
+    'cf_comparison': plot_cf_comparison,
+    'sales_per_employee': plot_sales_per_employee,
+    'op_income_per_employee': plot_op_income_per_employee,
+    'sales_trend': plot_sales_trend,
+    'margin_trend': plot_margin_trend,
+}
+
+def get_view_charts(view):
+    """ビューで描画されるチャートIDの一覧（画面の表示条件と同じ）"""
+    if view['df_compare'].empty:
+        chart_ids = []
+    else:
+        chart_ids = [
+            'pl_composition', 'operating_margin',
+            'total_assets', 'equity_ratio',
+            'inventory_vs_margin', 'asset_turnover',
+        ]
+        if any(col in view['df_compare'].columns for col in ['営業CF', '投資CF', 'フリーCF']):
+            chart_ids += ['operating_cf', 'free_cf', 'cf_comparison']
+        chart_ids += ['sales_per_employee', 'op_income_per_employee']
+    if not view['df_trend'].empty:
+        chart_ids += ['sales_trend', 'margin_trend']
+    return chart_ids
+
+# ==========================================
+# 7. デプロイ用バンドル
+# ==========================================
+# バンドル形式を変えたときに上げる
+BUNDLE_VERSION = 5
+
+# 初期表示の条件（app.py のサイドバー初期値と揃える）
+DEFAULT_UNIT_SCALE = 1_000_000_000
+DEFAULT_UNIT_LABEL = "10億ドル"
+
+def _file_digest(path):
+    """ファイル内容のSHA-256"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def get_bundle_signature():
+    """
+    バンドルの鮮度判定に使う署名。
+    データファイルと描画コード（このファイル）のどちらかが変われば無効になる。
+    """
+    return {
+        'version': BUNDLE_VERSION,
+        'data': _file_digest(DATA_PATH),
+        'code': _file_digest(os.path.abspath(__file__)),
+        'matplotlib': matplotlib.__version__,
+    }
+
+def prerender_chart(fig):
+    """
+    事前描画用にFigureを画面用PNGに変換する。
+    バンドルを小さく保つため256色に減色して保存し（チャートは色数が少なく見た目はほぼ変わらない）、
+    レポート用画像は保存せず、必要になった時点で変換・メモ化する。
+    """
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(render_figure(fig)['png'])).convert('RGB')
+    buf = io.BytesIO()
+    img.quantize(colors=256).save(buf, format='PNG', optimize=True)
+    return {'png': buf.getvalue()}
+
+def build_bundle(path=BUNDLE_PATH):
+    """
+    Excelの読み込み結果・集計済みデータ（類似度・指標ピボット）・各カテゴリ初期表示のチャート画像を
+    1つのバイナリファイルにまとめる。
+    """
+    df = pd.read_excel(DATA_PATH)
+    available_companies = sorted(df['企業名'].unique().tolist())
+    latest_year = sorted(df['決算年度'].unique())[-1]
+    category_index = load_category_index(available_companies)
+    metric_pivot = build_metric_pivot(df)
+
+    images = {}
+    for category in category_index['categories']:
+        _, default_selection = get_category_options(category, available_companies, category_index)
+        if not default_selection:
+            continue
+        view = build_view(df, default_selection, latest_year, DEFAULT_UNIT_SCALE, DEFAULT_UNIT_LABEL)
+        key = view_key(view)
+        if key in images:
+            continue
+        images[key] = {
+            chart_id: prerender_chart(CHART_BUILDERS[chart_id](view))
+            for chart_id in get_view_charts(view)
+        }
+
+        # ヒートマップタブの初期表示（先頭の指標、Zスコアなし）
+        heatmap_metric = get_heatmap_metrics(metric_pivot)[0]
+        matrix, unit = build_heatmap_matrix(
+            metric_pivot, heatmap_metric, default_selection, DEFAULT_UNIT_SCALE, DEFAULT_UNIT_LABEL
+        )
+        if not matrix.isna().all().all():
+            images[key][heatmap_chart_id(heatmap_metric)] = prerender_chart(
+                plot_metric_heatmap(matrix, heatmap_metric, unit)
+            )
+
+    bundle = {
+        'signature': get_bundle_signature(),
+        'df': df,
+        'similarity_index': build_similarity_index(df),
+        'metric_pivot': metric_pivot,
+        'images': images,
+    }
+    with open(path, 'wb') as f:
+        pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return bundle
+
+@st.cache_resource
+def load_bundle(path=BUNDLE_PATH):
+    """
+    ビルド済みバンドルを読み込む。
+    存在しない・古い（データまたは描画コードが更新された）場合は None を返し、
+    呼び出し側はその場での計算にフォールバックする。
+    """
+    if not (os.path.exists(path) and os.path.exists(DATA_PATH)):
+        return None
+
+    try:
+        with open(path, 'rb') as f:
+            bundle = pickle.load(f)
+    except Exception:
+        return None
+
+    if bundle.get('signature') != get_bundle_signature():
+        return None
+    return bundle
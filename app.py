@@ -1,14 +1,7 @@
 import streamlit as st
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.font_manager as fm
-import seaborn as sns
-import os
-import io
 
 # ==========================================
-# 1. 設定 & フォント読み込み
+# 1. 設定
 # ==========================================
 st.set_page_config(
     page_title="米国主要小売業 財務分析ダッシュボード",
@@ -16,130 +9,57 @@ st.set_page_config(
     page_icon="🇺🇸"
 )
 
-def setup_font():
+# データ読み込み・集計・チャート描画は analysis.py に集約
+from analysis import (
+    CHART_BUILDERS,
+    format_fy, get_html_report, render_figure,
+    load_category_index,
+    get_category_options, get_company_categories, get_category_overlap, CUSTOM_CATEGORY,
+    load_data, load_bundle,
+    build_similarity_index, find_similar_companies,
+    build_view, view_key,
+    build_metric_pivot, get_heatmap_matrix, get_heatmap_metrics, build_heatmap_matrix, heatmap_chart_id, plot_metric_heatmap,
+    TABLE_PAGE_SIZE, CHART_TOP_N,
+    REPORT_IMAGE_FORMATS, DEFAULT_REPORT_IMAGE_OPTIONS,
+)
+
+def draw_chart(chart_id, view, prerendered, formats=('png',)):
     """
-    fontsフォルダから日本語フォントを読み込む。
-    Cloud環境とローカル環境の両方に対応。
+    チャートを描画して画像（形式 -> バイト列）を返す。
+    ビルド済みバンドルに同じ条件の画像があれば描画を省略する。
     """
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    font_path = os.path.join(current_dir, "fonts", "ipaexg.ttf")
-    
-    if os.path.exists(font_path):
-        fm.fontManager.addfont(font_path)
-        prop = fm.FontProperties(fname=font_path)
-        plt.rcParams['font.family'] = prop.get_name()
-        return prop.get_name()
-    else:
-        # フォールバック
-        default_fonts = ['Meiryo', 'Yu Gothic', 'Hiragino Sans', 'TakaoGothic', 'IPAGothic']
-        plt.rcParams['font.family'] = default_fonts
-        return 'sans-serif'
-
-font_name = setup_font()
-sns.set_theme(style="whitegrid", rc={"font.family": font_name})
-
-# ==========================================
-# 2. カラーパレット定義（app_compare.pyと統一）
-# ==========================================
-COLORS = {
-    'primary': ['#2E86AB', '#A23B72', '#F18F01', '#C73E1D', '#3B1F2B', '#95C623', '#5C4D7D'],
-    'accent': '#FF6B6B',
-    'background': '#F8F9FA',
-    'text': '#2C3E50'
-}
+    images = prerendered.get(chart_id)
+    if images is not None and 'svg' not in formats:
+        return images
+    return render_figure(CHART_BUILDERS[chart_id](view), formats)
 
-def get_company_colors(companies):
-    """企業ごとに一貫した色を割り当て"""
-    return {company: COLORS['primary'][i % len(COLORS['primary'])] for i, company in enumerate(companies)}
-
-# ==========================================
-# 3. ユーティリティ関数
-# ==========================================
-def format_fy(year):
-    """年度をFYフォーマットに変換"""
-    try:
-        return f"FY{int(year)}"
-    except:
-        return year
-
-def safe_divide(numerator, denominator, default=0):
-    """ゼロ除算を回避する除算"""
-    return np.where(denominator != 0, numerator / denominator, default)
-
-def get_html_report(df, title, fig=None):
-    """HTMLダウンロード用データの生成（テーブル＋チャート）"""
-    import base64
-    from io import BytesIO
-    
-    # チャートをbase64エンコード
-    chart_html = ""
-    if fig is not None:
-        buf = BytesIO()
-        fig.savefig(buf, format='png', dpi=150, bbox_inches='tight', facecolor='white')
-        buf.seek(0)
-        img_base64 = base64.b64encode(buf.read()).decode('utf-8')
-        buf.close()
-        chart_html = f'<div style="text-align:center; margin: 20px 0;"><img src="data:image/png;base64,{img_base64}" style="max-width:100%;"/></div>'
-    
-    return f"""
-    <html><head><meta charset='utf-8'>
-    <style>
-        body {{ font-family: 'Hiragino Sans', 'Meiryo', sans-serif; padding: 20px; background: #f5f5f5; }}
-        .container {{ max-width: 1200px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-        table {{ border-collapse: collapse; width: 100%; margin-top: 20px; background: white; }}
-        th, td {{ border: 1px solid #ddd; padding: 10px; text-align: right; }}
-        th {{ background: linear-gradient(135deg, #2E86AB, #A23B72); color: white; text-align: center; }}
-        tr:nth-child(even) {{ background-color: #f9f9f9; }}
-        tr:hover {{ background-color: #f0f0f0; }}
-        h2 {{ color: #2C3E50; border-left: 5px solid #2E86AB; padding-left: 15px; margin-top: 0; }}
-        .timestamp {{ color: #888; font-size: 12px; text-align: right; margin-top: 20px; }}
-    </style></head>
-    <body>
-    <div class="container">
-        <h2>{title}</h2>
-        {chart_html}
-        <h3>📋 詳細データ</h3>
-        {df.to_html(classes='data-table')}
-        <p class="timestamp">生成日時: {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
-    </div>
-    </body></html>
+def render_chart(chart_id, view, prerendered, formats=('png',)):
     """
+    チャートを表示して描画済み画像を返す。
+    画面表示とレポートは同じ描画結果を共有する。
+    """
+    images = draw_chart(chart_id, view, prerendered, formats)
+    st.image(images['png'], use_column_width=True)
+    return images
 
-# ==========================================
-# 4. カテゴリグループ定義
-# ==========================================
-CATEGORY_GROUPS = {
-    'スーパー/BigBox': [
-        'Walmart', 'Target', 'Kroger', 'Costco', 'Albertsons', 
-        'PriceSmart', "BJ's Wholesale", 'Sprouts Farmers Market', 
-        'Ingles Markets', 'Weis Markets'
-    ],
-    'ドラッグストア/医薬卸': [
-        'CVS Health', 'McKesson', 'Cencora', 'Cardinal Health'
-    ],
-    'ホームセンター': [
-        'Home Depot', "Lowe's", 'Floor & Decor'
-    ],
-    'Eコマース': [
-        'Amazon', 'eBay', 'Etsy'
-    ],
-    'カスタム': []
-}
-
-# ==========================================
-# 5. データ読み込み & 前処理
-# ==========================================
-@st.cache_data
-def load_data():
-    """Excelデータを読み込む"""
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(current_dir, "data", "financial_data_us.xlsx")
-    
-    if not os.path.exists(file_path):
-        return None
+def show_table(table_data, formats, key):
+    """
+    詳細データを表示する。
+    行数が多い場合はページ分割し、書式設定は表示中のページにだけ適用する。
+    """
+    n_rows = len(table_data)
+    if n_rows > TABLE_PAGE_SIZE:
+        n_pages = (n_rows - 1) // TABLE_PAGE_SIZE + 1
+        page = st.number_input("ページ", min_value=1, max_value=n_pages, value=1, key=f"{key}_page")
+        start = (page - 1) * TABLE_PAGE_SIZE
+        end = min(start + TABLE_PAGE_SIZE, n_rows)
+        st.caption(f"{start + 1}〜{end}件目 / 全{n_rows}件")
+        table_data = table_data.iloc[start:end]
     
-    df = pd.read_excel(file_path)
-    return df
+    st.dataframe(
+        table_data.style.format(formats),
+        use_container_width=True
+    )
 
 # ==========================================
 # 6. メイン UI
@@ -168,7 +88,12 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-df_raw = load_data()
+# ビルド済みバンドルがあれば利用し、なければExcelからその場で計算する
+bundle = load_bundle()
+if bundle is not None:
+    df_raw = bundle['df']
+else:
+    df_raw = load_data()
 
 # ==========================================
 # 7. サイドバー設定
@@ -204,22 +129,54 @@ st.sidebar.markdown("---")
 # --- 業態カテゴリ選択 ---
 st.sidebar.subheader("1️⃣ 業態を選択")
 available_companies = sorted(df_raw['企業名'].unique().tolist())
+all_years = sorted(df_raw['決算年度'].unique())
+similarity_index = bundle['similarity_index'] if bundle is not None else build_similarity_index(df_raw)
+metric_pivot = bundle['metric_pivot'] if bundle is not None else build_metric_pivot(df_raw)
+category_index = load_category_index(available_companies)
 
 selected_category_group = st.sidebar.radio(
     "カテゴリ",
-    list(CATEGORY_GROUPS.keys())
+    category_index['categories']
 )
 
+# 他カテゴリとの重複（同じ企業が複数の業態に登録されている場合）
+if selected_category_group != CUSTOM_CATEGORY:
+    overlaps = []
+    for category in category_index['members']:
+        shared = get_category_overlap(category_index, selected_category_group, category)
+        if category != selected_category_group and shared:
+            overlaps.append(f"{category}（{len(shared)}社）")
+    if overlaps:
+        st.sidebar.caption("重複するカテゴリ: " + " / ".join(overlaps))
+
 # --- 企業選択 ---
 st.sidebar.subheader("2️⃣ 企業を選択")
 
-if selected_category_group == 'カスタム':
-    options = available_companies
-    default_selection = options[:3] if len(options) >= 3 else options
-else:
-    target_list = CATEGORY_GROUPS[selected_category_group]
-    options = [c for c in target_list if c in available_companies]
-    default_selection = options
+options, default_selection = get_category_options(selected_category_group, available_companies, category_index)
+
+# --- 類似企業検索 ---
+with st.sidebar.expander("🔍 類似企業を検索"):
+    similarity_base = st.selectbox(
+        "基準企業",
+        ["（使用しない）"] + available_companies
+    )
+    similarity_top_n = st.slider("表示社数", 1, 10, 5)
+    
+    if similarity_base != "（使用しない）":
+        # 年度セレクタは後段で描画されるため、前回の選択値を参照する
+        similarity_year = st.session_state.get('selected_year', all_years[-1])
+        similar = find_similar_companies(similarity_index, similarity_year, similarity_base, similarity_top_n)
+        
+        if similar.empty:
+            st.caption(f"{format_fy(similarity_year)}の比較データがありません。")
+        else:
+            st.caption(f"{format_fy(similarity_year)} 財務プロファイル距離（小さいほど類似）")
+            similar_table = similar.rename('距離').to_frame()
+            similar_table['業態'] = [" / ".join(get_company_categories(category_index, c)) for c in similar.index]
+            st.dataframe(similar_table.style.format({'距離': '{:.2f}'}), use_container_width=True)
+            default_selection = [similarity_base] + similar.index.tolist()
+            option_set = set(options)
+            options = options + [c for c in default_selection if c not in option_set]
 
 selected_companies = st.sidebar.multiselect(
     "比較対象企業",
@@ -235,47 +192,87 @@ if not selected_companies:
 st.sidebar.markdown("---")
 st.sidebar.subheader("3️⃣ 決算年度")
 
-all_years = sorted(df_raw['決算年度'].unique())
 selected_year = st.sidebar.selectbox(
     "比較基準年度",
     all_years,
-    index=len(all_years) - 1
+    index=len(all_years) - 1,
+    key='selected_year'
 )
 
 # --- トレンド分析オプション ---
 show_trend = st.sidebar.checkbox("📈 過去トレンドを表示", value=True)
 
-# データフィルタリング
-df_compare = df_raw[
-    (df_raw['企業名'].isin(selected_companies)) & 
-    (df_raw['決算年度'] == selected_year)
-].copy()
-
-# トレンド用データ（過去5年）
-if show_trend:
-    trend_years = [y for y in range(selected_year - 4, selected_year + 1) if y in all_years]
-    df_trend = df_raw[
-        (df_raw['企業名'].isin(selected_companies)) & 
-        (df_raw['決算年度'].isin(trend_years))
-    ].copy()
-else:
-    df_trend = pd.DataFrame()
+# --- レポート画像設定 ---
+with st.sidebar.expander("📥 レポート画像の設定"):
+    report_format = st.radio(
+        "画像形式",
+        REPORT_IMAGE_FORMATS,
+        index=REPORT_IMAGE_FORMATS.index(DEFAULT_REPORT_IMAGE_OPTIONS['format']),
+        horizontal=True
+    )
+    report_width_options = [800, 1200, 1600, "原寸"]
+    report_width = st.selectbox(
+        "最大幅 (px)",
+        report_width_options,
+        index=report_width_options.index(DEFAULT_REPORT_IMAGE_OPTIONS['max_width'])
+    )
+    report_max_kb = st.number_input(
+        "1枚あたりの容量上限 (KB、0で無制限)", min_value=0, value=0, step=50,
+        help="上限に収まるまで画質・画像サイズを下げます。SVGが上限を超える場合はPNGに変換して埋め込みます。"
+    )
+    report_include_trend = st.checkbox("過去トレンドをレポートに含める", value=True, disabled=not show_trend)
+
+report_image_options = {
+    'format': report_format,
+    'max_width': None if report_width == "原寸" else report_width,
+    'max_bytes': report_max_kb * 1024 or None,
+}
+# SVG出力時は画面用の描画と同時にベクター形式も書き出す
+chart_formats = ('png', 'svg') if report_format == 'SVG' else ('png',)
+
+view = build_view(df_raw, selected_companies, selected_year, unit_scale, unit_label, show_trend)
+df_compare = view['df_compare']
+df_trend = view['df_trend']
+trend_years = view['trend_years']
 
-# 企業ごとの色を設定
-company_colors = get_company_colors(selected_companies)
+# 初期表示と同じ条件ならビルド時に描画済みの画像を使う
+prerendered = bundle['images'].get(view_key(view), {}) if bundle is not None else {}
+
+# トレンドチャートは各タブのレポートにも含めるため先に描画し、画面表示は末尾で行う
+trend_charts = {}
+report_trend = None
+if show_trend and not df_trend.empty:
+    trend_title = f"📈 過去トレンド分析 ({format_fy(min(trend_years))}〜{format_fy(max(trend_years))})"
+    trend_charts = {
+        chart_id: draw_chart(chart_id, view, prerendered, chart_formats)
+        for chart_id in ['sales_trend', 'margin_trend']
+    }
+    if report_include_trend:
+        report_trend = (trend_title, [
+            ("売上高推移", trend_charts['sales_trend']),
+            ("営業利益率推移", trend_charts['margin_trend']),
+        ])
 
 # ==========================================
 # 8. メインコンテンツ（タブ）
 # ==========================================
 st.markdown(f"**カテゴリ:** {selected_category_group} | **基準年度:** {format_fy(selected_year)} | **表示単位:** {unit_option}")
 
+if view['large_selection']:
+    st.info(
+        f"ℹ️ {len(selected_companies)}社が選択されています。"
+        f"チャートは売上高上位{CHART_TOP_N}社と「その他」の合計で表示し、"
+        f"詳細データは{TABLE_PAGE_SIZE}件ずつ表示します。"
+    )
+
 # タブ作成
-tab_pl, tab_bs, tab_metrics, tab_cf, tab_prod = st.tabs([
+tab_pl, tab_bs, tab_metrics, tab_cf, tab_prod, tab_heatmap = st.tabs([
     "💰 損益計算書", 
     "📊 貸借対照表", 
     "📈 財務指標", 
     "💵 キャッシュフロー",
-    "👥 労働生産性"
+    "👥 労働生産性",
+    "🗺️ ヒートマップ"
 ])
 
 # ---------------------------------------------------------
@@ -287,53 +284,21 @@ with tab_pl:
     if df_compare.empty:
         st.warning(f"{format_fy(selected_year)}年度のデータがありません。")
     else:
-        df_display = df_compare.sort_values('売上高', ascending=False)
-        
         col1, col2 = st.columns([2, 1])
         
         with col1:
             st.markdown("##### 📊 売上構成（積み上げ）")
-            plot_data = df_display[['企業名', '売上原価', '販管費', '営業利益']].set_index('企業名')
-            plot_data = plot_data / unit_scale
-            
-            fig1, ax1 = plt.subplots(figsize=(10, 6))
-            plot_data.plot(
-                kind='bar', 
-                stacked=True, 
-                ax=ax1, 
-                color=['#A9A9A9', '#87CEEB', '#FF8C00']
-            )
-            ax1.set_ylabel(f"金額 ({unit_label})")
-            ax1.set_xlabel("")
-            ax1.legend(["売上原価", "販管費", "営業利益"], loc='upper right')
-            ax1.set_title(f'{format_fy(selected_year)} 売上構成', fontweight='bold')
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            st.pyplot(fig1)
+            chart_pl_composition = render_chart('pl_composition', view, prerendered, chart_formats)
         
         with col2:
             st.markdown("##### 📈 営業利益率比較")
-            fig2, ax2 = plt.subplots(figsize=(5, 6))
-            colors_list = [company_colors[c] for c in df_display['企業名']]
-            sns.barplot(
-                data=df_display, 
-                y='企業名', 
-                x='営業利益率', 
-                ax=ax2, 
-                palette=colors_list
-            )
-            ax2.set_xlabel("営業利益率 (%)")
-            ax2.set_ylabel("")
-            ax2.grid(axis='x', linestyle='--', alpha=0.7)
-            ax2.set_title('営業利益率', fontweight='bold')
-            plt.tight_layout()
-            st.pyplot(fig2)
+            chart_operating_margin = render_chart('operating_margin', view, prerendered, chart_formats)
         
         # データテーブル
         st.markdown("---")
         st.markdown("##### 📋 詳細データ")
         
-        table_data = df_display[[
+        table_data = df_compare.sort_values('売上高', ascending=False)[[
             '企業名', '売上高', '売上原価', '販管費', '営業利益', 
             '売上総利益率', '営業利益率', '販管費率'
         ]].copy()
@@ -343,8 +308,9 @@ with tab_pl:
             table_data[col] = table_data[col] / unit_scale
         
         table_data = table_data.set_index('企業名')
-        st.dataframe(
-            table_data.style.format({
+        show_table(
+            table_data,
+            {
                 '売上高': '{:,.1f}',
                 '売上原価': '{:,.1f}',
                 '販管費': '{:,.1f}',
@@ -352,12 +318,18 @@ with tab_pl:
                 '売上総利益率': '{:.1f}%',
                 '営業利益率': '{:.1f}%',
                 '販管費率': '{:.1f}%'
-            }),
-            use_container_width=True
+            },
+            key="pl_table"
         )
         
         # HTMLダウンロード
-        html_content = get_html_report(table_data, f"損益計算書比較 - {format_fy(selected_year)}", fig1)
+        html_content = get_html_report(
+            table_data,
+            f"損益計算書比較 - {format_fy(selected_year)}",
+            [("📊 売上構成（積み上げ）", chart_pl_composition), ("📈 営業利益率比較", chart_operating_margin)],
+            report_image_options,
+            report_trend
+        )
         st.download_button(
             "📥 HTMLでダウンロード（チャート＋テーブル）", 
             html_content, 
@@ -375,49 +347,21 @@ with tab_bs:
     if df_compare.empty:
         st.warning(f"{format_fy(selected_year)}年度のデータがありません。")
     else:
-        df_display = df_compare.sort_values('総資産', ascending=False)
-        
         col1, col2 = st.columns(2)
         
         with col1:
             st.markdown("##### 📊 総資産規模")
-            fig3, ax3 = plt.subplots(figsize=(10, 6))
-            colors_list = [company_colors[c] for c in df_display['企業名']]
-            ax3.bar(
-                df_display['企業名'], 
-                df_display['総資産'] / unit_scale,
-                color=colors_list
-            )
-            ax3.set_ylabel(f"総資産 ({unit_label})")
-            ax3.set_title('総資産比較', fontweight='bold')
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            st.pyplot(fig3)
+            chart_total_assets = render_chart('total_assets', view, prerendered, chart_formats)
         
         with col2:
             st.markdown("##### 💼 自己資本比率")
-            fig4, ax4 = plt.subplots(figsize=(10, 6))
-            sns.barplot(
-                data=df_display,
-                x='企業名',
-                y='自己資本比率',
-                palette=colors_list,
-                ax=ax4
-            )
-            ax4.set_ylabel("自己資本比率 (%)")
-            ax4.set_xlabel("")
-            ax4.set_title('自己資本比率', fontweight='bold')
-            ax4.axhline(y=50, color='red', linestyle='--', linewidth=1, alpha=0.7, label='50%基準線')
-            ax4.legend()
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            st.pyplot(fig4)
+            chart_equity_ratio = render_chart('equity_ratio', view, prerendered, chart_formats)
         
         # データテーブル
         st.markdown("---")
         st.markdown("##### 📋 詳細データ")
         
-        table_data = df_display[[
+        table_data = df_compare.sort_values('総資産', ascending=False)[[
             '企業名', '総資産', '流動資産', '棚卸資産', 
             '純資産', '有利子負債', '自己資本比率'
         ]].copy()
@@ -428,20 +372,27 @@ with tab_bs:
                 table_data[col] = table_data[col] / unit_scale
         
         table_data = table_data.set_index('企業名')
-        st.dataframe(
-            table_data.style.format({
+        show_table(
+            table_data,
+            {
                 '総資産': '{:,.1f}',
                 '流動資産': '{:,.1f}',
                 '棚卸資産': '{:,.1f}',
                 '純資産': '{:,.1f}',
                 '有利子負債': '{:,.1f}',
                 '自己資本比率': '{:.1f}%'
-            }),
-            use_container_width=True
+            },
+            key="bs_table"
         )
         
         # HTMLダウンロード
-        html_content = get_html_report(table_data, f"貸借対照表比較 - {format_fy(selected_year)}", fig3)
+        html_content = get_html_report(
+            table_data,
+            f"貸借対照表比較 - {format_fy(selected_year)}",
+            [("📊 総資産規模", chart_total_assets), ("💼 自己資本比率", chart_equity_ratio)],
+            report_image_options,
+            report_trend
+        )
         st.download_button(
             "📥 HTMLでダウンロード（チャート＋テーブル）", 
             html_content, 
@@ -459,79 +410,47 @@ with tab_metrics:
     if df_compare.empty:
         st.warning(f"{format_fy(selected_year)}年度のデータがありません。")
     else:
-        df_display = df_compare.copy()
-        
         col1, col2 = st.columns(2)
         
         with col1:
             st.markdown("##### 📦 在庫効率 vs 収益性")
-            fig5, ax5 = plt.subplots(figsize=(8, 6))
-            
-            for company in df_display['企業名']:
-                company_data = df_display[df_display['企業名'] == company]
-                ax5.scatter(
-                    company_data['棚卸資産回転率'],
-                    company_data['営業利益率'],
-                    s=200,
-                    color=company_colors[company],
-                    label=company,
-                    alpha=0.7
-                )
-                # ラベル追加
-                ax5.text(
-                    company_data['棚卸資産回転率'].values[0],
-                    company_data['営業利益率'].values[0] + 0.3,
-                    company,
-                    fontsize=9,
-                    ha='center'
-                )
-            
-            ax5.set_xlabel("棚卸資産回転率 (回)")
-            ax5.set_ylabel("営業利益率 (%)")
-            ax5.set_title('在庫効率と収益性', fontweight='bold')
-            ax5.grid(True, linestyle=':', alpha=0.7)
-            plt.tight_layout()
-            st.pyplot(fig5)
+            chart_inventory_vs_margin = render_chart('inventory_vs_margin', view, prerendered, chart_formats)
         
         with col2:
             st.markdown("##### 🔄 総資産回転率")
-            fig6, ax6 = plt.subplots(figsize=(8, 6))
-            colors_list = [company_colors[c] for c in df_display['企業名']]
-            ax6.barh(
-                df_display['企業名'],
-                df_display['総資産回転率'],
-                color=colors_list
-            )
-            ax6.set_xlabel("総資産回転率 (回)")
-            ax6.set_title('総資産回転率', fontweight='bold')
-            ax6.grid(axis='x', linestyle='--', alpha=0.7)
-            plt.tight_layout()
-            st.pyplot(fig6)
+            chart_asset_turnover = render_chart('asset_turnover', view, prerendered, chart_formats)
         
         # データテーブル
         st.markdown("---")
         st.markdown("##### 📋 詳細データ")
         
-        table_data = df_display[[
+        table_data = df_compare[[
             '企業名', '営業利益率', '売上総利益率', '販管費率',
             '棚卸資産回転率', '総資産回転率', '自己資本比率'
         ]].copy()
         
         table_data = table_data.set_index('企業名')
-        st.dataframe(
-            table_data.style.format({
+        show_table(
+            table_data,
+            {
                 '営業利益率': '{:.1f}%',
                 '売上総利益率': '{:.1f}%',
                 '販管費率': '{:.1f}%',
                 '棚卸資産回転率': '{:.2f}',
                 '総資産回転率': '{:.2f}',
                 '自己資本比率': '{:.1f}%'
-            }),
-            use_container_width=True
+            },
+            key="metrics_table"
         )
         
         # HTMLダウンロード
-        html_content = get_html_report(table_data, f"財務指標比較 - {format_fy(selected_year)}", fig5)
+        html_content = get_html_report(
+            table_data,
+            f"財務指標比較 - {format_fy(selected_year)}",
+            [("📦 在庫効率 vs 収益性", chart_inventory_vs_margin), ("🔄 総資産回転率", chart_asset_turnover)],
+            report_image_options,
+            report_trend
+        )
         st.download_button(
             "📥 HTMLでダウンロード（チャート＋テーブル）", 
             html_content, 
@@ -549,11 +468,9 @@ with tab_cf:
     if df_compare.empty:
         st.warning(f"{format_fy(selected_year)}年度のデータがありません。")
     else:
-        df_display = df_compare.copy()
-        
         # CF項目の確認
         cf_columns = ['営業CF', '投資CF', 'フリーCF']
-        available_cf = [col for col in cf_columns if col in df_display.columns]
+        available_cf = [col for col in cf_columns if col in df_compare.columns]
         
         if not available_cf:
             st.info("キャッシュフローデータが利用できません。")
@@ -562,81 +479,47 @@ with tab_cf:
             
             with col1:
                 st.markdown("##### 💵 営業キャッシュフロー")
-                fig7, ax7 = plt.subplots(figsize=(10, 6))
-                cf_colors = ['#2E86AB' if v >= 0 else '#C73E1D' 
-                            for v in df_display['営業CF']]
-                ax7.bar(
-                    df_display['企業名'],
-                    df_display['営業CF'] / unit_scale,
-                    color=cf_colors
-                )
-                ax7.axhline(y=0, color='black', linewidth=0.5)
-                ax7.set_ylabel(f"営業CF ({unit_label})")
-                ax7.set_title('営業キャッシュフロー', fontweight='bold')
-                plt.xticks(rotation=45, ha='right')
-                plt.tight_layout()
-                st.pyplot(fig7)
+                chart_operating_cf = render_chart('operating_cf', view, prerendered, chart_formats)
             
             with col2:
                 st.markdown("##### 💰 フリーキャッシュフロー")
-                fig8, ax8 = plt.subplots(figsize=(10, 6))
-                free_colors = ['#95C623' if v >= 0 else '#C73E1D' 
-                              for v in df_display['フリーCF']]
-                ax8.bar(
-                    df_display['企業名'],
-                    df_display['フリーCF'] / unit_scale,
-                    color=free_colors
-                )
-                ax8.axhline(y=0, color='black', linewidth=0.5)
-                ax8.set_ylabel(f"フリーCF ({unit_label})")
-                ax8.set_title('フリーキャッシュフロー', fontweight='bold')
-                plt.xticks(rotation=45, ha='right')
-                plt.tight_layout()
-                st.pyplot(fig8)
+                chart_free_cf = render_chart('free_cf', view, prerendered, chart_formats)
             
             # CF比較チャート
             st.markdown("---")
             st.markdown("##### 📊 キャッシュフロー構成比較")
-            
-            fig9, ax9 = plt.subplots(figsize=(12, 5))
-            x = np.arange(len(df_display))
-            width = 0.25
-            
-            ax9.bar(x - width, df_display['営業CF'] / unit_scale, 
-                   width, label='営業CF', color='#2E86AB')
-            ax9.bar(x, df_display['投資CF'] / unit_scale, 
-                   width, label='投資CF', color='#F18F01')
-            ax9.bar(x + width, df_display['フリーCF'] / unit_scale, 
-                   width, label='フリーCF', color='#95C623')
-            
-            ax9.axhline(y=0, color='black', linewidth=0.5)
-            ax9.set_xticks(x)
-            ax9.set_xticklabels(df_display['企業名'], rotation=45, ha='right')
-            ax9.legend()
-            ax9.set_ylabel(f'金額 ({unit_label})')
-            ax9.set_title('キャッシュフロー比較', fontweight='bold')
-            plt.tight_layout()
-            st.pyplot(fig9)
+            chart_cf_comparison = render_chart('cf_comparison', view, prerendered, chart_formats)
             
             # データテーブル
             st.markdown("---")
             st.markdown("##### 📋 詳細データ")
             
             table_columns = ['企業名'] + available_cf
-            table_data = df_display[table_columns].copy()
+            table_data = df_compare[table_columns].copy()
             
             # 金額を単位変換
             for col in available_cf:
                 table_data[col] = table_data[col] / unit_scale
             
             table_data = table_data.set_index('企業名')
-            st.dataframe(
-                table_data.style.format('{:,.1f}'),
-                use_container_width=True
+            show_table(
+                table_data,
+                '{:,.1f}',
+                key="cf_table"
             )
             
             # HTMLダウンロード
-            html_content = get_html_report(table_data, f"キャッシュフロー比較 - {format_fy(selected_year)}", fig9)
+            html_content = get_html_report(
+                table_data,
+                f"キャッシュフロー比較 - {format_fy(selected_year)}",
+                [
+                    ("💵 営業キャッシュフロー", chart_operating_cf),
+                    ("💰 フリーキャッシュフロー", chart_free_cf),
+                    ("📊 キャッシュフロー構成比較", chart_cf_comparison),
+                ],
+                report_image_options,
+                report_trend
+            )
             st.download_button(
                 "📥 HTMLでダウンロード（チャート＋テーブル）", 
                 html_content, 
@@ -654,77 +537,46 @@ with tab_prod:
     if df_compare.empty:
         st.warning(f"{format_fy(selected_year)}年度のデータがありません。")
     else:
-        df_display = df_compare.copy()
-        
-        # 生産性指標の確認
-        has_productivity = '全従業員1人当り売上高' in df_display.columns
-        
-        if not has_productivity:
-            # データにない場合は計算
-            df_display['全従業員1人当り売上高'] = safe_divide(
-                df_display['売上高'], 
-                df_display['従業員数']
-            ) / 1000  # 千ドル単位
-            
-            df_display['全従業員1人当り営業利益'] = safe_divide(
-                df_display['営業利益'], 
-                df_display['従業員数']
-            ) / 1000  # 千ドル単位
-        
         col1, col2 = st.columns(2)
         
         with col1:
             st.markdown("##### 👥 従業員1人当り売上高")
-            fig10, ax10 = plt.subplots(figsize=(10, 6))
-            colors_list = [company_colors[c] for c in df_display['企業名']]
-            ax10.bar(
-                df_display['企業名'],
-                df_display['全従業員1人当り売上高'],
-                color=colors_list
-            )
-            ax10.set_ylabel("売上高 (千ドル / 人)")
-            ax10.set_title('従業員1人当り売上高', fontweight='bold')
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            st.pyplot(fig10)
+            chart_sales_per_employee = render_chart('sales_per_employee', view, prerendered, chart_formats)
         
         with col2:
             st.markdown("##### 💼 従業員1人当り営業利益")
-            fig11, ax11 = plt.subplots(figsize=(10, 6))
-            ax11.bar(
-                df_display['企業名'],
-                df_display['全従業員1人当り営業利益'],
-                color='#F18F01'
-            )
-            ax11.set_ylabel("営業利益 (千ドル / 人)")
-            ax11.set_title('従業員1人当り営業利益', fontweight='bold')
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            st.pyplot(fig11)
+            chart_op_income_per_employee = render_chart('op_income_per_employee', view, prerendered, chart_formats)
         
         # データテーブル
         st.markdown("---")
         st.markdown("##### 📋 詳細データ")
         
-        table_data = df_display[[
+        table_data = df_compare[[
             '企業名', '従業員数', 
             '全従業員1人当り売上高', '全従業員1人当り営業利益'
         ]].copy()
         
         table_data = table_data.set_index('企業名')
-        st.dataframe(
-            table_data.style.format({
+        show_table(
+            table_data,
+            {
                 '従業員数': '{:,.0f}',
                 '全従業員1人当り売上高': '{:.1f}',
                 '全従業員1人当り営業利益': '{:.1f}'
-            }),
-            use_container_width=True
+            },
+            key="prod_table"
         )
         
         st.caption("※「従業員1人当り」指標の単位は千ドルです。")
         
         # HTMLダウンロード
-        html_content = get_html_report(table_data, f"労働生産性比較 - {format_fy(selected_year)}", fig10)
+        html_content = get_html_report(
+            table_data,
+            f"労働生産性比較 - {format_fy(selected_year)}",
+            [("👥 従業員1人当り売上高", chart_sales_per_employee), ("💼 従業員1人当り営業利益", chart_op_income_per_employee)],
+            report_image_options,
+            report_trend
+        )
         st.download_button(
             "📥 HTMLでダウンロード（チャート＋テーブル）", 
             html_content, 
@@ -733,62 +585,94 @@ with tab_prod:
             key="prod_dl"
         )
 
+# ---------------------------------------------------------
+# Tab 6: ヒートマップ（全年度 × 企業）
+# ---------------------------------------------------------
+with tab_heatmap:
+    st.subheader("指標ヒートマップ - 全年度")
+    
+    col1, col2 = st.columns([2, 1])
+    with col1:
+        heatmap_metric = st.selectbox(
+            "指標",
+            get_heatmap_metrics(metric_pivot),
+            key="heatmap_metric"
+        )
+    with col2:
+        # Zスコアは企業間の比較のため、2社以上選択時のみ有効
+        heatmap_zscore = st.checkbox(
+            "年度ごとにZスコア正規化",
+            value=False,
+            key="heatmap_zscore",
+            disabled=len(selected_companies) < 2,
+            help="2社以上を選択すると使用できます。"
+        ) and len(selected_companies) >= 2
+    
+    heatmap_matrix, heatmap_unit = build_heatmap_matrix(
+        metric_pivot, heatmap_metric, selected_companies, unit_scale, unit_label, heatmap_zscore
+    )
+    
+    if heatmap_matrix.isna().all().all():
+        if heatmap_zscore and not get_heatmap_matrix(metric_pivot, heatmap_metric, selected_companies).isna().all().all():
+            st.info("Zスコアには、同じ年度に値の異なる2社以上のデータが必要です。")
+        else:
+            st.info(f"{heatmap_metric}のデータがありません。")
+    else:
+        # 初期表示と同じ条件ならビルド時に描画済みの画像を使う
+        chart_heatmap = None if heatmap_zscore or 'svg' in chart_formats else prerendered.get(heatmap_chart_id(heatmap_metric))
+        if chart_heatmap is None:
+            chart_heatmap = render_figure(
+                plot_metric_heatmap(heatmap_matrix, heatmap_metric, heatmap_unit, heatmap_zscore),
+                chart_formats
+            )
+        st.image(chart_heatmap['png'], use_column_width=True)
+        
+        if heatmap_zscore:
+            st.caption("※ 各年度内で選択企業の平均0・標準偏差1に正規化しています（赤: 平均以上 / 青: 平均以下）。")
+        
+        # データテーブル
+        st.markdown("---")
+        st.markdown("##### 📋 詳細データ")
+        
+        table_data = heatmap_matrix.copy()
+        table_data.columns = [format_fy(y) for y in table_data.columns]
+        show_table(
+            table_data,
+            '{:.2f}' if heatmap_zscore or heatmap_unit == '回' else '{:,.1f}',
+            key="heatmap_table"
+        )
+        
+        # HTMLダウンロード
+        html_content = get_html_report(
+            table_data,
+            f"{heatmap_metric} ヒートマップ" + ("（Zスコア）" if heatmap_zscore else ""),
+            chart_heatmap,
+            report_image_options
+        )
+        st.download_button(
+            "📥 HTMLでダウンロード（チャート＋テーブル）", 
+            html_content, 
+            "heatmap.html", 
+            "text/html",
+            key="heatmap_dl"
+        )
+
 # ---------------------------------------------------------
 # トレンド分析（オプション）
 # ---------------------------------------------------------
-if show_trend and not df_trend.empty:
+if trend_charts:
     st.divider()
-    st.subheader(f"📈 過去トレンド分析 ({format_fy(min(trend_years))}〜{format_fy(max(trend_years))})")
+    st.subheader(trend_title)
     
     col1, col2 = st.columns(2)
     
     with col1:
         st.markdown("##### 売上高推移")
-        fig_trend1, ax_trend1 = plt.subplots(figsize=(10, 6))
-        
-        for company in selected_companies:
-            company_trend = df_trend[df_trend['企業名'] == company].sort_values('決算年度')
-            if not company_trend.empty:
-                ax_trend1.plot(
-                    company_trend['決算年度'].apply(format_fy),
-                    company_trend['売上高'] / unit_scale,
-                    marker='o',
-                    label=company,
-                    color=company_colors[company],
-                    linewidth=2
-                )
-        
-        ax_trend1.set_ylabel(f'売上高 ({unit_label})')
-        ax_trend1.set_title('売上高推移', fontweight='bold')
-        ax_trend1.legend(loc='best', fontsize=9)
-        ax_trend1.grid(True, linestyle=':', alpha=0.7)
-        plt.xticks(rotation=45, ha='right')
-        plt.tight_layout()
-        st.pyplot(fig_trend1)
+        st.image(trend_charts['sales_trend']['png'], use_column_width=True)
     
     with col2:
         st.markdown("##### 営業利益率推移")
-        fig_trend2, ax_trend2 = plt.subplots(figsize=(10, 6))
-        
-        for company in selected_companies:
-            company_trend = df_trend[df_trend['企業名'] == company].sort_values('決算年度')
-            if not company_trend.empty:
-                ax_trend2.plot(
-                    company_trend['決算年度'].apply(format_fy),
-                    company_trend['営業利益率'],
-                    marker='s',
-                    label=company,
-                    color=company_colors[company],
-                    linewidth=2
-                )
-        
-        ax_trend2.set_ylabel('営業利益率 (%)')
-        ax_trend2.set_title('営業利益率推移', fontweight='bold')
-        ax_trend2.legend(loc='best', fontsize=9)
-        ax_trend2.grid(True, linestyle=':', alpha=0.7)
-        plt.xticks(rotation=45, ha='right')
-        plt.tight_layout()
-        st.pyplot(fig_trend2)
+        st.image(trend_charts['margin_trend']['png'], use_column_width=True)
 
 # ---------------------------------------------------------
 # フッター
@@ -0,0 +1,31 @@
+"""
+デプロイ用バンドルのビルド
+
+Excelの読み込み結果・集計済みデータ・各カテゴリ初期表示のチャート画像を
+data/app_bundle.pkl にまとめる。アプリは起動時にこのファイルを読み込み、
+データファイルまたは analysis.py が更新されている場合はその場での計算に戻る。
+
+使い方:
+    python build_bundle.py
+"""
+import os
+import time
+
+from analysis import BUNDLE_PATH, build_bundle
+
+
+def main():
+    start = time.perf_counter()
+    bundle = build_bundle()
+    elapsed = time.perf_counter() - start
+
+    n_images = sum(len(charts) for charts in bundle['images'].values())
+    size_kb = os.path.getsize(BUNDLE_PATH) / 1024
+    print(f"✅ {BUNDLE_PATH} を作成しました")
+    print(f"   企業数: {bundle['df']['企業名'].nunique()} / 行数: {len(bundle['df'])}")
+    print(f"   事前描画: {len(bundle['images'])} ビュー / {n_images} チャート")
+    print(f"   サイズ: {size_kb:,.0f} KB / 所要時間: {elapsed:.1f} 秒")
+
+
+if __name__ == "__main__":
+    main()